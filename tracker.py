@@ -1,12 +1,20 @@
+import asyncio
 import imaplib
 import email
-import re
+import regex
 import json
-import requests
+import sqlite3
+import functools
+import aiohttp
 import smtplib
 import os
+import time
 import logging
-from bs4 import BeautifulSoup
+import lxml.etree
+import lxml.html
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.charset import Charset, QP
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from dotenv import load_dotenv
@@ -38,34 +46,203 @@ SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL")
 
+STATE_DB_FILE = "active.db"
+# JSON state files from older versions, imported into the database on first start
 ACTIVE_IDS_FILE = "active_ids.json"
-WAYBILL_REGEX = r"\b\d{11}\b"
+DELIVERED_IDS_FILE = "delivered_ids.json"
+# Possessive quantifiers (regex module) never backtrack on long runs of digits or markup
+WAYBILL_RE = regex.compile(r"\b\d{11}+\b")
+HTML_TAG_RE = regex.compile(r"<[^>]++>")
+UNSEEN_COUNT_RE = regex.compile(rb"UNSEEN (\d+)")
+MAX_CONCURRENT_FETCHES = 10
+HTTP_MAX_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.3
+HTTP_RETRY_STATUSES = {500, 502, 503, 504}
+EVENT_CACHE_TTL = 90  # Seconds a scraped event is reused instead of fetching the page again
+EVENT_CACHE_SIZE = 256
+IMAP_FETCH_BATCH = 100  # Keeps FETCH commands under server request size limits
+EMAIL_PARSE_WORKERS = 4
+
+# Set POLL_INTERVAL=0 to run a single cycle and exit (e.g. when scheduled by cron)
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 300))
+# Upper bound for any blocking IMAP/SMTP call, so a silently dropped socket can't hang the daemon
+MAIL_TIMEOUT = 30
+# Most providers drop idle sessions at ~30 minutes, so reconnect before that
+IDLE_RECONNECT_AFTER = 25 * 60
 
 # ===================== FUNCTIONS =====================
 
-def load_active_ids():
-    """Loads the active waybill IDs from a JSON file."""
+def open_state_db():
+    """Opens the SQLite state database, creating the schema and importing legacy JSON state."""
+    conn = sqlite3.connect(STATE_DB_FILE)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS waybills ("
+        "id TEXT PRIMARY KEY, last_event TEXT, delivered INTEGER NOT NULL DEFAULT 0, etag TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS waybills_delivered ON waybills (delivered)")
+    import_legacy_json(conn, ACTIVE_IDS_FILE)
+    import_legacy_json(conn, DELIVERED_IDS_FILE, delivered=True)
+    conn.commit()
+    return conn
+
+def import_legacy_json(conn, path, delivered=False):
+    """Imports a JSON state file written by older versions, then renames it out of the way."""
     try:
-        with open(ACTIVE_IDS_FILE, "r") as f:
-            return json.load(f)
+        with open(path, "r") as f:
+            data = json.load(f)
     except FileNotFoundError:
-        logging.info(f"'{ACTIVE_IDS_FILE}' not found. Starting with an empty list.")
-        return {}
+        return
     except json.JSONDecodeError:
-        logging.error(f"Could not decode JSON from '{ACTIVE_IDS_FILE}'. Starting fresh.")
-        return {}
-
-def save_active_ids(data):
-    """Saves the active waybill IDs to a JSON file."""
-    with open(ACTIVE_IDS_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+        logging.error(f"Could not decode JSON from '{path}'. Skipping import.")
+        return
+    try:
+        for wb, value in data.items():
+            if delivered:
+                # The archive maps each waybill straight to its final event
+                row = (wb, json.dumps(value), 1, None)
+            else:
+                row = (wb, json.dumps(value.get("last_event")), int(bool(value.get("delivered"))), value.get("etag"))
+            conn.execute("INSERT OR IGNORE INTO waybills (id, last_event, delivered, etag) VALUES (?, ?, ?, ?)", row)
+    except (AttributeError, TypeError) as e:
+        conn.rollback()
+        logging.error(f"Unexpected data in '{path}': {e}. Skipping import.")
+        return
+    # Commit before moving the file aside, so a crash can never lose the imported rows
+    conn.commit()
+    os.replace(path, path + ".migrated")
+    logging.info(f"Imported {len(data)} waybill(s) from '{path}' into '{STATE_DB_FILE}'.")
+
+def load_active_ids(conn):
+    """Loads the active (non-delivered) waybills as {id: {"last_event": ..., "etag": ...}}."""
+    rows = conn.execute("SELECT id, last_event, etag FROM waybills WHERE delivered = 0")
+    return {wb: {"last_event": json.loads(last_event), "etag": etag} for wb, last_event, etag in rows}
+
+def add_waybill(conn, waybill):
+    """Starts tracking a waybill. Returns False if it is already active or delivered."""
+    cursor = conn.execute("INSERT OR IGNORE INTO waybills (id, last_event) VALUES (?, 'null')", (waybill,))
+    return cursor.rowcount == 1
+
+def save_waybill(conn, waybill, info, delivered=False):
+    """Stores a waybill's latest event and ETag, touching the row only if something changed."""
+    last_event = json.dumps(info.get("last_event"))
+    conn.execute(
+        "UPDATE waybills SET last_event = ?, etag = ?, delivered = ? WHERE id = ? "
+        "AND (last_event IS NOT ? OR etag IS NOT ? OR delivered IS NOT ?)",
+        (last_event, info.get("etag"), int(delivered), waybill, last_event, info.get("etag"), int(delivered))
+    )
+
+def connect_imap():
+    """Opens and authenticates a new IMAP connection."""
+    mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT, timeout=MAIL_TIMEOUT)
+    mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+    # imaplib keeps the pre-login capability list; servers such as Dovecot add UNSELECT after auth
+    status, data = mail.capability()
+    if status == "OK" and data and data[-1]:
+        mail.capabilities = tuple(data[-1].decode().upper().split())
+    return mail
+
+def connect_smtp():
+    """Opens and authenticates a new SMTP connection."""
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=MAIL_TIMEOUT)
+    server.starttls()
+    server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+    return server
+
+def ensure_imap(mail, idle_for):
+    """Returns a live IMAP connection, reusing `mail` if it still answers a NOOP."""
+    if mail is not None:
+        if idle_for < IDLE_RECONNECT_AFTER:
+            try:
+                mail.noop()
+                return mail
+            except (imaplib.IMAP4.error, OSError):
+                logging.info("IMAP connection was dropped or rejected NOOP. Reconnecting.")
+        try:
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+    try:
+        return connect_imap()
+    except (imaplib.IMAP4.error, OSError) as e:
+        logging.error(f"IMAP connection failed: {e}")
+        return None
+
+def ensure_smtp(server, idle_for):
+    """Returns `server` if it still answers a NOOP, otherwise None so it is reopened lazily."""
+    if server is None:
+        return None
+    if idle_for < IDLE_RECONNECT_AFTER:
+        try:
+            server.noop()
+            return server
+        except (smtplib.SMTPServerDisconnected, OSError):
+            logging.info("SMTP connection was dropped by the server. Reconnecting on next send.")
+    server.close()
+    return None
 
-def fetch_waybills_from_email():
-    """Connects to IMAP and extracts waybill numbers from UNREAD emails."""
+def _decode_part(part):
+    """Decodes a MIME part's payload to text, or returns an empty string."""
+    try:
+        return part.get_payload(decode=True).decode(errors="ignore")
+    except Exception:
+        return ""
+
+def extract_waybills(msg):
+    """Returns the waybill numbers in an email, preferring text/plain parts over text/html."""
+    html_parts = []
+    for part in msg.walk():
+        # Check the headers before decoding so attachments are never base64-decoded
+        ctype = part.get_content_type()
+        if ctype not in ("text/plain", "text/html"):
+            continue
+        if part.get_content_disposition() == "attachment":
+            continue
+        if ctype == "text/html":
+            # Usually an alternative rendering of the plain text, so only decoded as a fallback
+            html_parts.append(part)
+            continue
+        found = WAYBILL_RE.findall(_decode_part(part))
+        # Waybills typically appear in a single part, so stop walking at the first hit
+        if found:
+            return set(found)
+
+    for part in html_parts:
+        found = WAYBILL_RE.findall(HTML_TAG_RE.sub(" ", _decode_part(part)))
+        if found:
+            return set(found)
+    return set()
+
+def _extract_waybills_from_bytes(raw_email):
+    """Parses a raw RFC822 message and returns the waybill numbers it contains."""
+    return extract_waybills(email.message_from_bytes(raw_email))
+
+def release_mailbox(mail):
+    """Deselects the current mailbox without ever expunging messages flagged \\Deleted."""
+    if mail.state != "SELECTED":
+        return
+    try:
+        if "UNSELECT" in mail.capabilities:
+            mail.unselect()
+        else:
+            # CLOSE expunges a read-write mailbox, so reopen it read-only (EXAMINE) first
+            mail.select("INBOX", readonly=True)
+            mail.close()
+    except (imaplib.IMAP4.error, OSError) as e:
+        logging.warning(f"Failed to deselect mailbox: {e}")
+
+def fetch_waybills_from_email(mail):
+    """Extracts waybill numbers from UNREAD emails over an open IMAP connection."""
     waybills = set()
+    if mail is None:
+        return waybills
     try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+        # STATUS is cheaper than SELECT + SEARCH when there is nothing new
+        status, data = mail.status("INBOX", "(UNSEEN)")
+        match = UNSEEN_COUNT_RE.search(data[0]) if status == "OK" else None
+        if match and int(match.group(1)) == 0:
+            logging.info("No new unread emails found.")
+            return waybills
+
         mail.select("INBOX")
         status, messages = mail.search(None, 'UNSEEN')
         if status != "OK":
@@ -75,86 +252,177 @@ def fetch_waybills_from_email():
         email_ids = messages[0].split()
         if not email_ids:
             logging.info("No new unread emails found.")
-            mail.logout()
             return waybills
         
         logging.info(f"Found {len(email_ids)} new email(s) to process.")
 
-        for num in email_ids:
-            _, msg_data = mail.fetch(num, "(RFC822)")
-            msg = email.message_from_bytes(msg_data[0][1])
-            content = ""
-            if msg.is_multipart():
-                for part in msg.walk():
-                    if part.get_content_type() in ["text/plain", "text/html"]:
-                        try:
-                            content += part.get_payload(decode=True).decode(errors="ignore")
-                        except:
-                            continue
-            else:
-                try:
-                    content = msg.get_payload(decode=True).decode(errors="ignore")
-                except:
-                    pass
-
-            found = re.findall(WAYBILL_REGEX, content)
-            for wb in found:
-                waybills.add(wb)
-            
-            mail.store(num, '+FLAGS', '\\Seen')
-
-        mail.logout()
-    except imaplib.IMAP4.error as e:
-        logging.error(f"IMAP connection failed: {e}")
+        # BODY.PEEK[] leaves messages unread, so only those parsed below get flagged as seen
+        seen_ids = []
+        # The IMAP connection stays on this thread; only MIME parsing and regex scans are pooled
+        with ThreadPoolExecutor(max_workers=EMAIL_PARSE_WORKERS) as executor:
+            for batch in (email_ids[i:i + IMAP_FETCH_BATCH] for i in range(0, len(email_ids), IMAP_FETCH_BATCH)):
+                status, msg_data = mail.fetch(b",".join(batch), "(BODY.PEEK[])")
+                if status != "OK":
+                    logging.error("Failed to fetch a batch of emails.")
+                    continue
+
+                # The response interleaves (envelope, body) tuples with b")" terminators
+                parts = [part for part in msg_data if isinstance(part, tuple)]
+                for found in executor.map(_extract_waybills_from_bytes, [body for _, body in parts]):
+                    waybills |= found
+                seen_ids.extend(envelope.split(None, 1)[0] for envelope, _ in parts)
+
+        # One STORE for every processed message instead of one per message
+        if seen_ids:
+            mail.store(b",".join(seen_ids), '+FLAGS', '\\Seen')
+    except (imaplib.IMAP4.error, OSError) as e:
+        logging.error(f"IMAP request failed: {e}")
+    finally:
+        # Leave no mailbox selected: STATUS must not be used on the selected mailbox (RFC 3501)
+        release_mailbox(mail)
     return waybills
 
-def fetch_latest_event(waybill):
-    """Scrapes the Blue Dart website for the latest tracking event for a waybill."""
+# waybill -> (time scraped, event), kept in least-recently-used order
+_event_cache = OrderedDict()
+
+def _get_cached_event(waybill):
+    """Returns the event scraped for a waybill within the last EVENT_CACHE_TTL seconds, if any."""
+    hit = _event_cache.get(waybill)
+    if hit is None or time.monotonic() - hit[0] >= EVENT_CACHE_TTL:
+        return None
+    _event_cache.move_to_end(waybill)
+    return hit[1]
+
+def _cache_event(waybill, event):
+    """Remembers a freshly scraped event, evicting the least recently used beyond EVENT_CACHE_SIZE."""
+    _event_cache[waybill] = (time.monotonic(), event)
+    _event_cache.move_to_end(waybill)
+    if len(_event_cache) > EVENT_CACHE_SIZE:
+        _event_cache.popitem(last=False)
+
+async def fetch_latest_event_async(session, semaphore, waybill, info):
+    """Scrapes the Blue Dart website for the latest tracking event for a waybill.
+
+    The page is revalidated with the ETag stored in `info`; on 304 Not Modified the
+    stored last event is returned without downloading or parsing the page. Events
+    scraped within the last EVENT_CACHE_TTL seconds are reused without any request.
+    """
+    cached = _get_cached_event(waybill)
+    if cached is not None:
+        return cached
+
     url = f"https://www.bluedart.com/trackdartresultthirdparty?trackFor=0&trackNo={waybill}"
-    headers = {"User-Agent": "Mozilla/5.0"}
+    headers = {}
+    if info.get("etag") and info.get("last_event"):
+        headers["If-None-Match"] = info["etag"]
     try:
-        # MODIFICATION: Added timeout and status check for robustness
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        scan_table = soup.find("div", id=f"SCAN{waybill}").find("table")
-        first_event_row = scan_table.find("tbody").find_all("tr")[0]
-        cols = first_event_row.find_all("td")
-        return {
-            "Location": cols[0].text.strip(),
-            "Details": cols[1].text.strip(),
-            "Date": cols[2].text.strip(),
-            "Time": cols[3].text.strip()
+        async with semaphore:
+            # Retries 5xx responses as well as connection errors and timeouts
+            for attempt in range(HTTP_MAX_RETRIES + 1):
+                can_retry = attempt < HTTP_MAX_RETRIES
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        if response.status in HTTP_RETRY_STATUSES and can_retry:
+                            await asyncio.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+                            continue
+                        if response.status == 304:
+                            _cache_event(waybill, info["last_event"])
+                            return info["last_event"]
+                        response.raise_for_status()
+                        html = await response.read()
+                        etag = response.headers.get("ETag")
+                        break
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if not can_retry:
+                        raise
+                    await asyncio.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+        # Parsing is cheap compared to the HTTP wait, so it stays in the coroutine
+        tree = lxml.html.fromstring(html)
+
+        # Select only the first scan row and its first four cells instead of every row
+        scan_div = tree.get_element_by_id(f"SCAN{waybill}", None)
+        if scan_div is None:
+            logging.warning(f"Failed to parse HTML for {waybill}. Website structure may have changed.")
+            return None
+        cols = scan_div.xpath("(.//tbody/tr)[1]/td[position() <= 4]")
+        event = {
+            "Location": cols[0].text_content().strip(),
+            "Details": cols[1].text_content().strip(),
+            "Date": cols[2].text_content().strip(),
+            "Time": cols[3].text_content().strip()
         }
-    # MODIFICATION: More specific error handling
-    except requests.exceptions.RequestException as e:
+        # Only remember the ETag once the page parsed, or a 304 would pin the stale event
+        info["etag"] = etag
+        _cache_event(waybill, event)
+        return event
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logging.warning(f"Network error fetching waybill {waybill}: {e}")
-    except (AttributeError, IndexError):
+    except (lxml.etree.ParserError, IndexError):
         logging.warning(f"Failed to parse HTML for {waybill}. Website structure may have changed.")
     return None
 
-def send_html_email(subject, html_content):
-    """Sends a formatted HTML email."""
+def create_http_session():
+    """Creates the keep-alive HTTP session shared by every Blue Dart request."""
+    timeout = aiohttp.ClientTimeout(total=10)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_FETCHES, limit_per_host=MAX_CONCURRENT_FETCHES)
+    return aiohttp.ClientSession(
+        timeout=timeout,
+        connector=connector,
+        headers={"User-Agent": "Mozilla/5.0"}
+    )
+
+async def fetch_all_events(session, active_ids, waybills):
+    """Fetches the latest event for every waybill concurrently over the shared session."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    tasks = [fetch_latest_event_async(session, semaphore, wb, active_ids[wb]) for wb in waybills]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+def build_email(subject, html_content, eight_bit):
+    """Builds the MIME message, sending the UTF-8 body as raw 8bit when the server allows it."""
+    charset = Charset("utf-8")
+    # 8bit skips transfer-encoding the body; quoted-printable is the 7bit-safe fallback
+    charset.body_encoding = None if eight_bit else QP
+
     msg = MIMEMultipart("alternative")
     msg["Subject"] = subject
     msg["From"] = EMAIL_ADDRESS
     msg["To"] = RECIPIENT_EMAIL
 
-    msg.attach(MIMEText(html_content, "html"))
-
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            server.sendmail(EMAIL_ADDRESS, RECIPIENT_EMAIL, msg.as_string())
-        logging.info(f"Email alert sent successfully to {RECIPIENT_EMAIL}")
-    except smtplib.SMTPException as e:
-        logging.error(f"Failed to send email: {e}")
-
-def build_html_message(waybill, event):
-    """Builds the HTML content for the notification email."""
-    return f"""
+    msg.attach(MIMEText(html_content, "html", charset))
+    return msg
+
+def send_html_email(server, subject, html_content):
+    """Sends a formatted HTML email, (re)connecting as needed. Returns the live SMTP connection."""
+    # A second attempt covers a connection that was dropped since the last NOOP
+    for _ in range(2):
+        try:
+            if server is None:
+                server = connect_smtp()
+            if server.has_extn("8bitmime"):
+                msg = build_email(subject, html_content, eight_bit=True)
+                server.sendmail(EMAIL_ADDRESS, RECIPIENT_EMAIL, msg.as_bytes(), mail_options=["BODY=8BITMIME"])
+            else:
+                msg = build_email(subject, html_content, eight_bit=False)
+                server.sendmail(EMAIL_ADDRESS, RECIPIENT_EMAIL, msg.as_string())
+            logging.info(f"Email alert sent successfully to {RECIPIENT_EMAIL}")
+            return server
+        except smtplib.SMTPServerDisconnected:
+            logging.info("SMTP connection was dropped by the server. Reconnecting.")
+            server = None
+        except (smtplib.SMTPException, OSError) as e:
+            logging.error(f"Failed to send email: {e}")
+            return server
+    logging.error("Failed to send email: SMTP server keeps disconnecting.")
+    return server
+
+def send_html_emails(server, pending_mails):
+    """Sends queued (subject, html) alerts back to back over one SMTP connection. Returns the live connection."""
+    for subject, html_content in pending_mails:
+        server = send_html_email(server, subject, html_content)
+    return server
+
+# Static email shell, formatted with str.format so the CSS block isn't rebuilt per message
+HTML_MESSAGE_TEMPLATE = """
     <html>
     <head>
         <style>
@@ -203,12 +471,12 @@ def build_html_message(waybill, event):
     <body>
         <div class="container">
             <h2>📦 New Bluedart Tracking Update</h2>
-            <div class="info"><span class="label">Location:</span> {event['Location']}</div>
-            <div class="info"><span class="label">Status:</span> {event['Details']}</div>
-            <div class="info"><span class="label">Date:</span> {event['Date']}</div>
-            <div class="info"><span class="label">Time:</span> {event['Time']}</div>
+            <div class="info"><span class="label">Location:</span> {Location}</div>
+            <div class="info"><span class="label">Status:</span> {Details}</div>
+            <div class="info"><span class="label">Date:</span> {Date}</div>
+            <div class="info"><span class="label">Time:</span> {Time}</div>
 
-            <a href="https://www.bluedart.com/trackdartresultthirdparty?trackFor=0&trackNo={waybill}" class="track-link">
+            <a href="{url}" class="track-link">
                 🔍 Track Your Package
             </a>
 
@@ -218,55 +486,123 @@ def build_html_message(waybill, event):
         </div>
     </body>
     </html>
-    """ 
+    """
+
+@functools.lru_cache(maxsize=128)
+def _build_html_message_cached(waybill, location, details, date, time_):
+    """Renders the email HTML for one event; cached across cycles and bounded by maxsize."""
+    url = f"https://www.bluedart.com/trackdartresultthirdparty?trackFor=0&trackNo={waybill}"
+    return HTML_MESSAGE_TEMPLATE.format(url=url, Location=location, Details=details, Date=date, Time=time_)
+
+def build_html_message(waybill, event):
+    """Builds the HTML content for the notification email, memoized per (waybill, event)."""
+    return _build_html_message_cached(
+        waybill, event["Location"], event["Details"], event["Date"], event["Time"]
+    )
 
 # ===================== MAIN EXECUTION =====================
 
-def main():
-    """Main function to orchestrate the tracking process."""
-    logging.info("--- Starting Blue Dart Tracking Script ---")
+async def run_tracking_cycle(conn, http, mail, smtp):
+    """Runs one tracking pass over the open connections. Returns the live SMTP connection."""
+    logging.info("--- Starting tracking cycle ---")
 
-    # Step 1: Load current active IDs
-    active_ids = load_active_ids()
+    # Step 1: Load the active (non-delivered) IDs
+    active_ids = load_active_ids(conn)
 
-    # Step 2: Check emails for new IDs
-    new_waybills = fetch_waybills_from_email()
+    # Step 2: Check emails for new IDs (IDs already delivered are ignored)
+    new_waybills = fetch_waybills_from_email(mail)
     for wb in new_waybills:
-        if wb not in active_ids:
-            active_ids[wb] = {"last_event": None, "delivered": False}
+        if add_waybill(conn, wb):
+            active_ids[wb] = {"last_event": None, "etag": None}
             logging.info(f"Added new tracking ID: {wb}")
-
-    # Step 3: Track each active (non-delivered) ID
-    # Create a copy of items to safely modify dict while iterating
-    for waybill, info in list(active_ids.items()):
-        if info.get("delivered", False):
-            continue
-
-        event = fetch_latest_event(waybill)
+    # Their emails are already flagged as seen, so persist new IDs before anything can fail
+    conn.commit()
+
+    # Step 3: Fetch the latest event of every active ID concurrently
+    pending = list(active_ids)
+    results = await fetch_all_events(http, active_ids, pending)
+
+    # Step 4: Process the results sequentially, queueing email alerts
+    pending_mails = []
+    for waybill, event in zip(pending, results):
+        if isinstance(event, Exception):
+            logging.error(f"Unexpected error fetching {waybill}: {event}")
+            event = None
         if not event:
             logging.warning(f"Could not fetch event for {waybill}, will retry next time.")
             continue
 
+        info = active_ids[waybill]
         if "Delivered" in event["Details"]:
             logging.info(f"Package {waybill} has been delivered. Deactivating tracking.")
-            active_ids[waybill]["delivered"] = True
-            active_ids[waybill]["last_event"] = event # Save the final delivery event
+            info["last_event"] = event # Save the final delivery event
+            save_waybill(conn, waybill, info, delivered=True)
             # Optional: Send one final "Delivered" notification
             html_msg = build_html_message(waybill, event)
-            send_html_email(f"✅ DELIVERED: Waybill {waybill}", html_msg)
+            pending_mails.append((f"[DELIVERED] Waybill {waybill}", html_msg))
             continue
         
         if event != info.get("last_event"):
             logging.info(f"New update found for {waybill}: {event['Details']}")
-            active_ids[waybill]["last_event"] = event
+            info["last_event"] = event
             html_msg = build_html_message(waybill, event)
-            send_html_email(f"📦 Update for Waybill {waybill}", html_msg)
+            pending_mails.append((f"[UPDATE] Waybill {waybill}", html_msg))
         else:
             logging.info(f"No new update for {waybill}. Current status: {event['Details']}")
+        # Also persists a refreshed ETag when the event itself is unchanged
+        save_waybill(conn, waybill, info)
+
+    # Step 5: Flush all queued alerts through a single SMTP session
+    smtp = send_html_emails(smtp, pending_mails)
+
+    # Step 6: Commit the state changes made during this cycle
+    conn.commit()
+    logging.info("--- Tracking cycle finished ---")
+    return smtp
+
+async def main_async():
+    """Keeps IMAP and SMTP connections alive and runs a tracking cycle every POLL_INTERVAL seconds."""
+    if POLL_INTERVAL > 0:
+        logging.info(f"--- Starting Blue Dart Tracking Daemon (polling every {POLL_INTERVAL}s) ---")
+    conn = open_state_db()
+    mail = smtp = None
+    last_cycle = time.monotonic()
+    try:
+        # One HTTP session for the daemon's lifetime so TLS handshakes are reused across cycles
+        async with create_http_session() as http:
+            while True:
+                idle_for = time.monotonic() - last_cycle
+                try:
+                    mail = ensure_imap(mail, idle_for)
+                    smtp = ensure_smtp(smtp, idle_for)
+                    smtp = await run_tracking_cycle(conn, http, mail, smtp)
+                except Exception:
+                    # One bad cycle must not stop the daemon; drop its partial state changes
+                    logging.exception("Tracking cycle failed. Retrying next cycle.")
+                    conn.rollback()
+                last_cycle = time.monotonic()
+                if POLL_INTERVAL <= 0:
+                    break
+                await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        conn.close()
+        if mail is not None:
+            try:
+                mail.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
 
-    # Step 4: Save updated active IDs
-    save_active_ids(active_ids)
-    logging.info("--- Script run finished ---")
+def main():
+    """Entry point that runs the tracking daemon until interrupted."""
+    try:
+        asyncio.run(main_async())
+    except KeyboardInterrupt:
+        logging.info("--- Tracking daemon stopped ---")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file